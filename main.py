@@ -9,10 +9,12 @@ as part of the REDCap custom record label. Like this, field workers will see in
 visit at their households."""
 
 from datetime import datetime
-from datetime import timedelta
-import math
+import itertools
+import numpy
 import pandas
+import re
 import redcap
+import string
 import tokens
 
 __author__ = "Maximo Ramirez Robles"
@@ -26,6 +28,118 @@ __email__ = "maximo.ramirez@isglobal.org"
 __status__ = "Dev"
 
 
+def prepare_redcap_data(redcap_data, date_columns):
+    """Cast the date columns used by the alert functions from str to datetime. REDCap exports dates as strings, so they
+    are parsed once here for all the alert functions. The exported data frame is not modified, a typed copy sorted by
+    record id and event is returned instead. Data frames already prepared are returned as they are and columns already
+    casted to datetime are not parsed again.
+
+    :param redcap_data: Exported REDCap project data
+    :type redcap_data: pandas.DataFrame
+    :param date_columns: Dictionary in which the keys are the date columns and the values are their REDCap formats
+    :type date_columns: dict
+
+    :return: A sorted copy of the REDCap project data with the date columns casted to datetime
+    :rtype: pandas.DataFrame
+
+    :raises ValueError: If a filled date does not match the REDCap format of its column
+    """
+    if redcap_data.attrs.get('_icaria_dt_parsed'):
+        return redcap_data
+
+    # Sort once, so that every record id groupby runs over contiguous rows without sorting the groups again
+    prepared_data = redcap_data.sort_index(level=['record_id', 'redcap_event_name'])
+    for column, date_format in date_columns.items():
+        if pandas.api.types.is_datetime64_any_dtype(prepared_data[column]):
+            continue
+        exported_dates = prepared_data[column]
+        prepared_data[column] = pandas.to_datetime(exported_dates, format=date_format, cache=True, errors='coerce')
+
+        # Blank dates become NaT, but a filled date not matching the format would silently drop alerts. Fail instead
+        unparsed_dates = exported_dates[exported_dates.notna() & prepared_data[column].isna()]
+        if not unparsed_dates.empty:
+            raise ValueError("{} dates of column {} do not match the format {}, e.g. {}".format(
+                len(unparsed_dates), column, date_format, unparsed_dates.iloc[0]))
+    prepared_data.attrs['_icaria_dt_parsed'] = True
+
+    return prepared_data
+
+
+def groupby_max_by_record(redcap_data, columns):
+    """Get the maximum value of each datetime column for every project record. Rows are sorted by record id (unless
+    they already are, like in the prepared data) and then each column is reduced with numpy.maximum.reduceat over its
+    int64 view. NaT values are ignored as they are represented by the lowest int64 value.
+
+    :param redcap_data: Exported REDCap project data with the date columns already casted to datetime
+    :type redcap_data: pandas.DataFrame
+    :param columns: List of datetime columns to be reduced
+    :type columns: list
+
+    :return: A dataframe with one column per reduced column in which each row is identified by the REDCap record id
+    :rtype: pandas.DataFrame
+    """
+    if redcap_data.empty:
+        return redcap_data[columns].droplevel('redcap_event_name')
+    if not redcap_data.index.is_monotonic_increasing:
+        redcap_data = redcap_data.sort_index(level=['record_id', 'redcap_event_name'])
+
+    # Rows of every record are contiguous, so each group starts where the record id changes
+    record_ids = redcap_data.index.get_level_values('record_id').values
+    starts = numpy.flatnonzero(numpy.concatenate(([True], record_ids[1:] != record_ids[:-1])))
+
+    maximums = {}
+    for column in columns:
+        values = redcap_data[column].values
+        maximums[column] = numpy.maximum.reduceat(values.view('i8'), starts).view(values.dtype)
+
+    return pandas.DataFrame(maximums, index=pandas.Index(record_ids[starts], name='record_id'))
+
+
+def difference_record_ids(record_ids, excluded_record_ids):
+    """Get the record ids which are not in a second array of record ids. Record ids are unique integers, so the
+    difference is computed with numpy.setdiff1d over the underlying arrays.
+
+    :param record_ids: Array of record ids to be filtered
+    :type record_ids: pandas.Int64Index
+    :param excluded_record_ids: Array of record ids to be removed from record_ids
+    :type excluded_record_ids: pandas.Int64Index
+
+    :return: Array of the record ids not present in excluded_record_ids, in the same order as in record_ids
+    :rtype: pandas.Int64Index
+    """
+    return pandas.Index(numpy.setdiff1d(record_ids.values, excluded_record_ids.values, assume_unique=True),
+                        name='record_id')
+
+
+def format_alert_strings(alert_string, fields):
+    """Fill the placeholders of an alert string with the values of every study participant. Each placeholder is replaced
+    by the corresponding column converted to str. Only plain named placeholders are supported, so placeholders with a
+    format spec or a conversion (e.g. {weeks:03d} or {community!r}) are rejected.
+
+    :param alert_string: String with the alert to be setup containing named placeholders
+    :type alert_string: str
+    :param fields: Dictionary (or dataframe) in which the keys are the placeholder names and the values are the series
+                   of values, all of them identified by the REDCap record id
+    :type fields: dict or pandas.DataFrame
+
+    :return: A series with the formatted alert of every study participant, or the alert string itself if it has no
+    placeholders
+    :rtype: pandas.Series or str
+
+    :raises ValueError: If a placeholder of the alert string has a format spec or a conversion
+    """
+    alert_strings = ''
+    for literal_text, field_name, format_spec, conversion in string.Formatter().parse(alert_string):
+        if format_spec or conversion:
+            raise ValueError("Unsupported format spec or conversion in placeholder {{{}}} of alert string: {}".format(
+                field_name, alert_string))
+        alert_strings = alert_strings + literal_text
+        if field_name is not None:
+            alert_strings = alert_strings + fields[field_name].astype(str)
+
+    return alert_strings
+
+
 def get_list_communities(redcap_project, choice_sep, code_sep):
     """Get list of communities in the health facility catchment area from the health facility REDCap project. This list
     is part of the metadata of the ID.community field.
@@ -38,13 +152,20 @@ def get_list_communities(redcap_project, choice_sep, code_sep):
     :param code_sep: Character used by REDCap to separated code and label in every choice when exporting meta-data
     :type code_sep: str
 
-    :return: A dictionary in which the keys are the community code and the values are the community names.
+    :return: A dictionary in which the keys are the community codes (as integers, like in the exported data) and the
+    values are the community names.
     :rtype: dict
     """
     community_field = redcap_project.export_metadata(fields=['community'], format='df')
     community_choices = community_field['select_choices_or_calculations'].community
     communities_string = community_choices.split(choice_sep)
-    return {community.split(code_sep)[0]: community.split(CODE_SEP)[1] for community in communities_string}
+
+    communities = {}
+    for community in communities_string:
+        code, _, name = community.partition(code_sep)
+        communities[int(code)] = name
+
+    return communities
 
 
 def get_record_ids_tbv(redcap_data):
@@ -62,75 +183,103 @@ def get_record_ids_tbv(redcap_data):
     visit
     :rtype: pandas.Int64Index
     """
-    azi_doses = redcap_data.groupby('record_id')['int_azi'].sum()
-    times_hh_child_seen = redcap_data.groupby('record_id')['hh_child_seen'].sum()
-    azi_supervision = azi_doses - times_hh_child_seen
+    # Sum AZi/Pbo doses and household visits in which the child was seen in a single groupby pass
+    azi_supervision = redcap_data.groupby('record_id', sort=False)[['int_azi', 'hh_child_seen']].sum()
+    azi_supervision = azi_supervision['int_azi'] - azi_supervision['hh_child_seen']
 
-    return azi_supervision[azi_supervision > 0].keys()
+    return azi_supervision[azi_supervision > 0].index
 
 
-def get_record_ids_nc(redcap_data, days_to_nc):
+def get_record_ids_nc(redcap_data, days_to_nc, today):
     """Get the project record ids of the participants requiring a household visit because they are non-compliant, i.e.
     they were expected in the Health Facility more than some weeks ago. Thus, for every project record, check
     if the return date of the last visit was more than some weeks ago and the participant hasn't a non-compliant visit
     yet.
 
-    :param redcap_data: Exported REDCap project data
+    :param redcap_data: Exported REDCap project data with the date columns already casted to datetime
     :type redcap_data: pandas.DataFrame
     :param days_to_nc: Number of days from the return date defined during the last visit to the HF to be considered as
                        a non-compliant participant
     :type days_to_nc: int
+    :param today: Reference date of the alerts run
+    :type today: numpy.datetime64
 
     :return: Array of record ids representing those study participants that are non-compliant (according to the
-    definition) and require a household visit to follow up on their status
-    :rtype: pandas.Int64Index
+    definition) and require a household visit to follow up on their status, and series with their last return dates
+    identified by the REDCap record id
+    :rtype: tuple(pandas.Int64Index, pandas.Series)
     """
 
-    # Cast int_next_visit column from str to date and get the last return date
-    x = redcap_data
-    x['int_next_visit'] = pandas.to_datetime(x['int_next_visit'])
-    x['comp_date'] = pandas.to_datetime(x['comp_date'])
-    last_return_dates = x.groupby('record_id')['int_next_visit'].max()
-    last_return_dates = last_return_dates[last_return_dates.notnull()]
-    last_nc_visits = x.groupby('record_id')['comp_date'].max()
-    last_nc_visits = last_nc_visits[last_return_dates.keys()]
+    # Get the last return date and the last non-compliant visit date
+    last_dates = groupby_max_by_record(redcap_data, ['int_next_visit', 'comp_date'])
+    last_return_dates = last_dates['int_next_visit'].values
+    last_nc_visits = last_dates['comp_date'].values
+
+    # Evaluate the non-compliant definition in a single vectorized mask over the per-record arrays. Comparisons with NaT
+    # are always False, so records without return date are never flagged and records without non-compliant visit are
+    # never considered as already visited
     already_visited = last_nc_visits > last_return_dates
-    days_delayed = datetime.today() - last_return_dates[~already_visited]
+    days_delayed = today - last_return_dates
+    non_compliant = ~already_visited & (days_delayed > numpy.timedelta64(days_to_nc, 'D'))
 
-    return days_delayed[days_delayed > timedelta(days=days_to_nc)].keys()
+    return last_dates.index[non_compliant], last_dates['int_next_visit'][non_compliant]
 
 
-def get_record_ids_nv(redcap_data, days_before, days_after):
+def get_record_ids_nv(redcap_data, days_before, days_after, today):
     """Get the project record ids of the participants who are expected to come to the HF in the interval days_before and
     days_after from today. Thus, for every project record, check if the return date of the last visit is in this
     interval and the participant didn't come yet.
 
-    :param redcap_data: Exported REDCap project data
+    :param redcap_data: Exported REDCap project data with the date columns already casted to datetime
     :type redcap_data: pandas.DataFrame
     :param days_before: Number of days before the return date to start alerting that the participant will come
     :type days_before: int
     :param days_after: Number of days after the return date to continue alerting that the participant should have come
     :type days_after: int
+    :param today: Reference date of the alerts run
+    :type today: numpy.datetime64
 
     :return: Array of record ids representing those study participants that will be flagged because their return date is
-    between the defined interval
-    :rtype: pandas.Int64Index
+    between the defined interval, and series with their last return dates identified by the REDCap record id
+    :rtype: tuple(pandas.Int64Index, pandas.Series)
+    """
+
+    # Get the last return date
+    last_return_dates = groupby_max_by_record(redcap_data, ['int_next_visit'])['int_next_visit']
+    days_to_come = today - last_return_dates.values
+
+    # Check the interval in a single boolean mask. Records without return date (NaT) are never in the interval
+    in_interval = ((days_to_come >= numpy.timedelta64(-days_before, 'D')) &
+                   (days_to_come < numpy.timedelta64(days_after, 'D')))
+
+    return last_return_dates.index[in_interval], last_return_dates[in_interval]
+
+
+def get_community_names(redcap_data, record_ids, catchment_communities):
+    """Get the community name of every study participant. Community codes not in the catchment communities are kept
+    as they are.
+
+    :param redcap_data: Exported REDCap project data
+    :type redcap_data: pandas.DataFrame
+    :param record_ids: Array of record ids of the study participants
+    :type record_ids: pandas.Int64Index
+    :param catchment_communities: Dictionary with the community codes attached to each community name
+    :type catchment_communities: dict
+
+    :return: A series with the community names in which each row is identified by the REDCap record id
+    :rtype: pandas.Series
     """
+    communities = redcap_data['community'][record_ids]
+    community_codes = communities.dropna().astype('int64')
 
-    # Cast int_next_visit column from str to date and get the last return date
-    x = redcap_data
-    x['int_next_visit'] = pandas.to_datetime(x['int_next_visit'])
-    last_return_dates = x.groupby('record_id')['int_next_visit'].max()
-    last_return_dates = last_return_dates[last_return_dates.notnull()]
-    days_to_come = datetime.today() - last_return_dates
+    # Codes not in the catchment communities (e.g. retired choices) are kept as they are
+    communities = community_codes.map(catchment_communities).fillna(community_codes.astype(str))
+    communities.index = communities.index.get_level_values('record_id')
 
-    before_today = days_to_come[timedelta(days=-days_before) <= days_to_come]
-    after_today = days_to_come[days_to_come < timedelta(days=days_after)]
-    return set(before_today.keys()) & set(after_today.keys())
+    return communities
 
 
-def build_tbv_alerts_df(redcap_data, record_ids, catchment_communities, alert_string, redcap_date_format,
-                        alert_date_format):
+def build_tbv_alerts_df(redcap_data, record_ids, catchment_communities, alert_string, alert_date_format):
     """Build dataframe with record ids, communities, date of last AZi/Pbo dose and follow up status of every study
     participant requiring an AZi/Pbo supervision household visit.
 
@@ -143,8 +292,6 @@ def build_tbv_alerts_df(redcap_data, record_ids, catchment_communities, alert_st
     :type catchment_communities: dict
     :param alert_string: String with the alert to be setup containing two placeholders (community & last AZi dose date)
     :type alert_string: str
-    :param redcap_date_format: Format of the dates in REDCap
-    :type redcap_date_format: str
     :param alert_date_format: Format of the date of the last AZi/Pbo dose to be displayed in the alert
     :type alert_date_format: str
 
@@ -152,30 +299,28 @@ def build_tbv_alerts_df(redcap_data, record_ids, catchment_communities, alert_st
     by the REDCap record id and represents a study participant to be visited.
     :rtype: pandas.DataFrame
     """
+    # Nothing to build if no participant has to be visited
+    if len(record_ids) == 0:
+        return pandas.DataFrame(columns=['community', 'last_azi_date', 'child_fu_status'])
+
     # Append to record ids, the participant's community name
-    communities_to_be_visited = redcap_data['community'][record_ids]
-    communities_to_be_visited = communities_to_be_visited[communities_to_be_visited.notnull()]
-    communities_to_be_visited = communities_to_be_visited.apply(int).apply(str).replace(catchment_communities)
-    communities_to_be_visited.index = communities_to_be_visited.index.get_level_values('record_id')
+    communities_to_be_visited = get_community_names(redcap_data, record_ids, catchment_communities)
 
     # Append to record ids, the date of last AZi/Pbo dose administered to the participant
     last_azi_doses = redcap_data.loc[record_ids, ['int_azi', 'int_date']]
     last_azi_doses = last_azi_doses[last_azi_doses['int_azi'] == 1]
-    last_azi_doses = last_azi_doses.groupby('record_id')['int_date'].max()
-    last_azi_doses = last_azi_doses.apply(lambda x: datetime.strptime(x, redcap_date_format))
-    last_azi_doses = last_azi_doses.apply(lambda x: x.strftime(alert_date_format))
+    last_azi_doses = last_azi_doses.groupby('record_id', sort=False)['int_date'].max()
+    last_azi_doses = last_azi_doses.dt.strftime(alert_date_format)
 
     # Transform data to be imported into the child_status_fu variable into the REDCap project
     data = {'community': communities_to_be_visited, 'last_azi_date': last_azi_doses}
     data_to_import = pandas.DataFrame(data)
-    if not data_to_import.empty:
-        data_to_import['child_fu_status'] = data_to_import[['community', 'last_azi_date']].apply(
-            lambda x: alert_string.format(community=x[0], last_azi_date=x[1]), axis=1)
+    data_to_import['child_fu_status'] = format_alert_strings(alert_string, data_to_import)
 
     return data_to_import
 
 
-def build_nc_alerts_df(redcap_data, record_ids, catchment_communities, alert_string):
+def build_nc_alerts_df(redcap_data, record_ids, last_return_dates, catchment_communities, alert_string, today):
     """Build dataframe with record ids, communities, non-compliant days and follow up status of every study participant
     who is non-compliant and requires a supervision household visit.
 
@@ -184,47 +329,49 @@ def build_nc_alerts_df(redcap_data, record_ids, catchment_communities, alert_str
     :param record_ids: Array of record ids representing those non-compliant participants that require a supervision
     household visit
     :type record_ids: pandas.Int64Index
+    :param last_return_dates: Last return dates of the non-compliant participants, as computed by get_record_ids_nc
+    :type last_return_dates: pandas.Series
     :param catchment_communities: Dictionary with the community codes attached to each community name
     :type catchment_communities: dict
     :param alert_string: String with the alert to be setup containing two placeholders (community & non-compliant weeks)
     :type alert_string: str
+    :param today: Reference date of the alerts run
+    :type today: numpy.datetime64
 
     :return: A dataframe with the columns community, nc_days and child_fu_status in which each row is identified by the
     REDCap record id and represents a study participant to be visited due to non-compliance.
     :rtype: pandas.DataFrame
     """
+    # Nothing to build if no participant is non-compliant
+    if len(record_ids) == 0:
+        return pandas.DataFrame(columns=['community', 'nc_days', 'child_fu_status'])
+
     # Append to record ids, the participant's community name
-    communities_to_be_visited = redcap_data['community'][record_ids]
-    communities_to_be_visited = communities_to_be_visited[communities_to_be_visited.notnull()]
-    communities_to_be_visited = communities_to_be_visited.apply(int).apply(str).replace(catchment_communities)
-    communities_to_be_visited.index = communities_to_be_visited.index.get_level_values('record_id')
-
-    # Append to record ids, the number of days since the return date set during the last HF visit
-    nc_days = redcap_data.loc[record_ids, 'int_next_visit']
-    nc_days = nc_days[nc_days.notnull()]
-    nc_days = pandas.to_datetime(nc_days)
-    nc_days = nc_days.groupby('record_id').max()
-    nc_days = datetime.today() - nc_days
+    communities_to_be_visited = get_community_names(redcap_data, record_ids, catchment_communities)
+
+    # Append to record ids, the number of days since the return date set during the last HF visit. The last return
+    # dates were already reduced per record when looking for the non-compliant participants
+    nc_days = today - last_return_dates[record_ids]
 
     # Transform data to be imported into the child_status_fu variable into the REDCap project
     data = {'community': communities_to_be_visited, 'nc_days': nc_days}
     data_to_import = pandas.DataFrame(data)
-    if not data_to_import.empty:
-        data_to_import['child_fu_status'] = data_to_import[['community', 'nc_days']].apply(
-            lambda x: alert_string.format(community=x[0], weeks=math.floor(x[1].days / 7)), axis=1)
+    nc_weeks = pandas.Series(data_to_import['nc_days'].values // numpy.timedelta64(7, 'D'), index=data_to_import.index)
+    data_to_import['child_fu_status'] = format_alert_strings(alert_string, {'community': data_to_import['community'],
+                                                                            'weeks': nc_weeks})
 
     return data_to_import
 
 
-def build_nv_alerts_df(redcap_data, record_ids, alert_string, alert_date_format):
+def build_nv_alerts_df(record_ids, last_return_dates, alert_string, alert_date_format):
     """Build dataframe with record ids and next return date to health facility of every study participant who is
     supposed to come in the next 7 days or is still expected in the health facility (still compliant).
 
-    :param redcap_data:Exported REDCap project data
-    :type redcap_data: pandas.DataFrame
     :param record_ids: Array of record ids representing those study participants that require a AZi/Pbo supervision
     household visit
     :type record_ids: pandas.Int64Index
+    :param last_return_dates: Last return dates of the participants, as computed by get_record_ids_nv
+    :type last_return_dates: pandas.Series
     :param alert_string: String with the alert to be setup containing one placeholders (next return date)
     :type alert_string: str
     :param alert_date_format: Format of the date of the next return date to be displayed in the alert
@@ -234,204 +381,260 @@ def build_nv_alerts_df(redcap_data, record_ids, alert_string, alert_date_format)
     record id and represents a study participant who is supposed to come to the health facility.
     :rtype: pandas.DataFrame
     """
-    # Append to record ids, the next return date of the participant
-    next_return_date = redcap_data.loc[record_ids, ['int_next_visit']]
-    next_return_date = next_return_date.groupby('record_id')['int_next_visit'].max()
-    next_return_date = next_return_date.apply(lambda x: x.strftime(alert_date_format))
+    # Nothing to build if no participant is expected in the health facility
+    if len(record_ids) == 0:
+        return pandas.DataFrame(columns=['return_date', 'child_fu_status'])
+
+    # Append to record ids, the next return date of the participant. The last return dates were already reduced per
+    # record when looking for the participants to flag
+    next_return_date = last_return_dates[record_ids].dt.strftime(alert_date_format)
 
     # Transform data to be imported into the child_status_fu variable into the REDCap project
     data = {'return_date': next_return_date}
     data_to_import = pandas.DataFrame(data)
-    if not data_to_import.empty:
-        data_to_import['child_fu_status'] = data_to_import[['return_date']].apply(
-            lambda x: alert_string.format(return_date=x[0]), axis=1)
+    data_to_import['child_fu_status'] = format_alert_strings(alert_string, data_to_import)
 
     return data_to_import
 
 
-def get_active_alerts(redcap_data, alert):
-    """Get the project records ids of the participants with an activated alert.
+def get_follow_up_statuses(redcap_data):
+    """Get the follow up statuses set up in the child_fu_status field of the project records. They are extracted once
+    per run and shared by all the functions looking for activated alerts or custom statuses.
 
     :param redcap_data: Exported REDCap project data
     :type redcap_data: pandas.DataFrame
+
+    :return: Follow up statuses of the participants who have one, indexed by record id
+    :rtype: pandas.Series
+    """
+    follow_up_statuses = redcap_data['child_fu_status'].xs('epipenta1_v0_recru_arm_1', level='redcap_event_name')
+
+    return follow_up_statuses.dropna()
+
+
+def classify_active_alerts(follow_up_statuses, defined_alerts):
+    """Classify the activated alerts of the project records by their alert type, matching every follow up status
+    against an alternation of the alert types.
+
+    :param follow_up_statuses: Follow up statuses of the participants who have one, indexed by record id
+    :type follow_up_statuses: pandas.Series
+    :param defined_alerts: List of strings representing the type of the defined alerts
+    :type defined_alerts: list
+
+    :return: A dictionary in which the keys are the alert types and the values are arrays containing the record ids of
+    the study participants who have an activated alert of that type. Empty if no participant has a follow up status.
+    :rtype: dict
+    """
+    if follow_up_statuses.empty:
+        return {}
+
+    # Longest alert types first, so an alert type which is a prefix of another one doesn't take its statuses
+    alert_types = sorted(defined_alerts, key=len, reverse=True)
+    alert_types_regex = '^(' + '|'.join(re.escape(alert) for alert in alert_types) + ')'
+    status_alert_types = follow_up_statuses.str.extract(alert_types_regex, expand=False).values
+    record_ids = follow_up_statuses.index
+
+    return {alert: record_ids[status_alert_types == alert] for alert in defined_alerts}
+
+
+def get_active_alerts(active_alerts, alert):
+    """Get the project records ids of the participants with an activated alert.
+
+    :param active_alerts: Activated alerts of the project records classified by alert type
+    :type active_alerts: dict
     :param alert: String representing the type of alerts to be retrieved
     :type alert: str
 
-    :return: Array containing the record ids of the study participants who have an activated alert.
+    :return: Array containing the record ids of the study participants who have an activated alert. None if no
+    participant has a follow up status.
     :rtype: pandas.Int64Index
     """
-    active_alerts = redcap_data.loc[(slice(None), 'epipenta1_v0_recru_arm_1'), 'child_fu_status']
-    active_alerts = active_alerts[active_alerts.notnull()]
-    if active_alerts.empty:
-        return None
-
-    active_alerts = active_alerts[active_alerts.str.startswith(alert)]
-    active_alerts.index = active_alerts.index.get_level_values('record_id')
+    return active_alerts.get(alert)
 
-    return active_alerts.keys()
 
-
-def get_record_ids_with_custom_status(redcap_data, defined_alerts):
+def get_record_ids_with_custom_status(follow_up_statuses, defined_alerts):
     """Get the project records ids of the participants with an custom status set up in the child_fu_status field.
 
-    :param redcap_data: Exported REDCap project data
-    :type redcap_data: pandas.DataFrame
+    :param follow_up_statuses: Follow up statuses of the participants who have one, indexed by record id
+    :type follow_up_statuses: pandas.Series
     :param defined_alerts: List of strings representing the type of the defined alerts
     :type defined_alerts: list
 
     :return: Array containing the record ids of those participants with a custom follow up status
     :rtype: pandas.Int64Index
     """
-    active_alerts = redcap_data.loc[(slice(None), 'epipenta1_v0_recru_arm_1'), 'child_fu_status']
-    active_alerts = active_alerts[active_alerts.notnull()]
-    if active_alerts.empty:
+    if follow_up_statuses.empty:
         return None
 
-    custom_status = active_alerts
+    # Check the defined alert types with numpy string operations over a fixed-width copy of the statuses
+    statuses = follow_up_statuses.values.astype(str)
+    is_defined_alert = numpy.zeros(statuses.size, dtype=bool)
     for alert in defined_alerts:
-        custom_status = custom_status[~active_alerts.str.startswith(alert)]
+        is_defined_alert |= numpy.char.startswith(statuses, alert)
+    custom_status = follow_up_statuses[~is_defined_alert]
+
+    return custom_status.index
 
-    custom_status.index = custom_status.index.get_level_values('record_id')
 
-    return custom_status.keys()
+def import_records_in_chunks(redcap_project, to_import_dict, chunk_size):
+    """Import records into the REDCap project in requests of at most chunk_size records. Like this, big payloads are
+    not serialized into a single JSON body and each request stays short. Overwrite is used, so blank values are saved.
+
+    :param redcap_project: A REDCap project class to communicate with the REDCap API
+    :type redcap_project: redcap.Project
+    :param to_import_dict: List of records to be imported, as dictionaries with the fields to be saved
+    :type to_import_dict: list
+    :param chunk_size: Maximum number of records imported per request
+    :type chunk_size: int
+
+    :return: Number of records imported according to the REDCap API
+    :rtype: int
+    """
+    imported = 0
+    for start in range(0, len(to_import_dict), chunk_size):
+        response = redcap_project.import_records(to_import_dict[start:start + chunk_size], overwrite='overwrite')
+        imported += response.get('count')
+
+    return imported
 
 
 # TO BE VISITED
-def set_tbv_alerts(redcap_project, redcap_project_df, tbv_alert, tbv_alert_string, redcap_date_format,
-                   alert_date_format, choice_sep, code_sep, blocked_records):
+def set_tbv_alerts(redcap_project_df, tbv_alert, tbv_alert_string, alert_date_format, communities, tbv_records,
+                   blocked_records, active_alerts):
     """Remove the Household to be visited alerts of those participants that have been already visited and setup new
-    alerts for these others that took recently AZi/Pbo and require a household visit.
+    alerts for these others that took recently AZi/Pbo and require a household visit. The records are not imported
+    here but returned, so that all the alert types of a project are imported together.
 
-    :param redcap_project: A REDCap project class to communicate with the REDCap API
-    :type redcap_project: redcap.Project
     :param redcap_project_df: Data frame containing all data exported from the REDCap project
     :type redcap_project_df: pandas.DataFrame
     :param tbv_alert: Code of the To Be Visited alerts
     :type tbv_alert: str
     :param tbv_alert_string: String with the alert to be setup
     :type tbv_alert_string: str
-    :param redcap_date_format: Format of the dates in REDCap
-    :type redcap_date_format: str
     :param alert_date_format: Format of the date of the last AZi/Pbo dose to be displayed in the alert
     :type alert_date_format: str
-    :param choice_sep: Character used by REDCap to separate choices in a categorical field (radio, dropdown) when
-                       exporting meta-data
-    :type choice_sep: str
-    :param code_sep: Character used by REDCap to separated code and label in every choice when exporting meta-data
-    :type code_sep: str
+    :param communities: Dictionary with the community codes attached to each community name
+    :type communities: dict
+    :param tbv_records: Array of record ids of the participants requiring a household visit after AZi/Pbo
+                        administration
+    :type tbv_records: pandas.Int64Index
     :param blocked_records: Array with the record ids that will be ignored during the alerts setup
     :type blocked_records: pandas.Int64Index
+    :param active_alerts: Activated alerts of the project records classified by alert type
+    :type active_alerts: dict
 
-    :return: None
+    :return: Records to be imported into the REDCap project to remove and setup the To Be Visited alerts
+    :rtype: list
     """
 
-    # Get the project records ids of the participants requiring a household visit
-    records_to_be_visited = get_record_ids_tbv(redcap_project_df)
+    # Project records ids of the participants requiring a household visit
+    records_to_be_visited = tbv_records
 
     # Remove those ids that must be ignored
     if blocked_records is not None:
-        records_to_be_visited = records_to_be_visited.difference(blocked_records)
+        records_to_be_visited = records_to_be_visited[~records_to_be_visited.isin(blocked_records)]
 
     # Get the project records ids of the participants with an active alert
-    records_with_alerts = get_active_alerts(redcap_project_df, tbv_alert)
+    records_with_alerts = get_active_alerts(active_alerts, tbv_alert)
 
     # Check which of the records with alerts are not anymore in the records to be visited (i.e. participants with an
     # activated alerts already visited)
+    to_remove_dict = []
     if records_with_alerts is not None:
-        alerts_to_be_removed = records_with_alerts.difference(records_to_be_visited)
+        alerts_to_be_removed = difference_record_ids(records_with_alerts, records_to_be_visited)
 
-        # Import data into the REDCap project: Alerts removal
-
-        to_import_dict = [{'record_id': rec_id, 'child_fu_status': ''} for rec_id in alerts_to_be_removed]
-        response = redcap_project.import_records(to_import_dict, overwrite='overwrite')
-        print("[TO BE VISITED] Alerts removal: {}".format(response.get('count')))
+        # Payload of the alerts removal
+        to_remove_dict = [{'record_id': rec_id, 'child_fu_status': ''} for rec_id in alerts_to_be_removed.tolist()]
+        print("[TO BE VISITED] Alerts removal: {}".format(len(to_remove_dict)))
     else:
         print("[TO BE VISITED] Alerts removal: None")
 
-    # Get list of communities in the health facility catchment area
-    communities = get_list_communities(redcap_project, choice_sep, code_sep)
-
-    # Build dataframe with fields to be imported into REDCap (record_id and child_fu_status)
-    to_import_df = build_tbv_alerts_df(redcap_project_df, records_to_be_visited, communities, tbv_alert_string,
-                                       redcap_date_format, alert_date_format)
+    # Payload of the alerts setup. Nothing to build if there are no participants to alert
+    to_setup_dict = []
+    if len(records_to_be_visited) > 0:
+        # Build dataframe with fields to be imported into REDCap (record_id and child_fu_status)
+        to_import_df = build_tbv_alerts_df(redcap_project_df, records_to_be_visited, communities, tbv_alert_string,
+                                           alert_date_format)
+        to_setup_dict = [{'record_id': rec_id, 'child_fu_status': child_fu_status}
+                         for rec_id, child_fu_status in zip(to_import_df.index,
+                                                            to_import_df['child_fu_status'].tolist())]
+    print("[TO BE VISITED] Alerts setup: {}".format(len(to_setup_dict)))
 
-    # Import data into the REDCap project: Alerts setup
-    to_import_dict = [{'record_id': rec_id, 'child_fu_status': participant.child_fu_status}
-                      for rec_id, participant in to_import_df.iterrows()]
-    response = redcap_project.import_records(to_import_dict)
-    print("[TO BE VISITED] Alerts setup: {}".format(response.get('count')))
+    # Alerts removal and setup, imported together with the rest of alert types of the project
+    return to_remove_dict + to_setup_dict
 
 
 # NON-COMPLIANT
-def set_nc_alerts(redcap_project, redcap_project_df, nc_alert, nc_alert_string, choice_sep, code_sep, days_to_nc,
-                  blocked_records):
+def set_nc_alerts(redcap_project_df, nc_alert, nc_alert_string, communities, days_to_nc, today, blocked_records,
+                  active_alerts):
     """Remove the Non-compliant alerts of those participants that have been already visited and setup new alerts for
-    these others that become non-compliant recently.
+    these others that become non-compliant recently. The records are returned to be imported with the rest of alerts.
 
-    :param redcap_project: A REDCap project class to communicate with the REDCap API
-    :type redcap_project: redcap.Project
     :param redcap_project_df: Data frame containing all data exported from the REDCap project
     :type redcap_project_df: pandas.DataFrame
     :param nc_alert: Code of the Non-Compliant alerts
     :type nc_alert: str
     :param nc_alert_string: String with the alert to be setup
     :type nc_alert_string: str
-    :param choice_sep: Character used by REDCap to separate choices in a categorical field (radio, dropdown) when
-                       exporting meta-data
-    :type choice_sep: str
-    :param code_sep: Character used by REDCap to separated code and label in every choice when exporting meta-data
-    :type code_sep: str
+    :param communities: Dictionary with the community codes attached to each community name
+    :type communities: dict
     :param days_to_nc: Definition of non-compliant participant - days since return date defined during last HF visit
     :type days_to_nc: int
+    :param today: Reference date of the alerts run
+    :type today: numpy.datetime64
     :param blocked_records: Array with the record ids that will be ignored during the alerts setup
     :type blocked_records: pandas.Int64Index
+    :param active_alerts: Activated alerts of the project records classified by alert type
+    :type active_alerts: dict
 
-    :return: None
+    :return: Records to be imported into the REDCap project to remove and setup the Non-Compliant alerts
+    :rtype: list
     """
 
     # Get the project records ids of the participants requiring a visit because they are non-compliant
-    records_to_be_visited = get_record_ids_nc(redcap_project_df, days_to_nc)
+    records_to_be_visited, last_return_dates = get_record_ids_nc(redcap_project_df, days_to_nc, today)
 
     # Remove those ids that must be ignored
     if blocked_records is not None:
-        records_to_be_visited = records_to_be_visited.difference(blocked_records)
+        records_to_be_visited = records_to_be_visited[~records_to_be_visited.isin(blocked_records)]
 
     # Get the project records ids of the participants with an active alert
-    records_with_alerts = get_active_alerts(redcap_project_df, nc_alert)
+    records_with_alerts = get_active_alerts(active_alerts, nc_alert)
 
     # Check which of the records with alerts are not anymore in the records to be visited (i.e. participants with an
     # activated alerts already visited)
+    to_remove_dict = []
     if records_with_alerts is not None:
-        alerts_to_be_removed = records_with_alerts.difference(records_to_be_visited)
+        alerts_to_be_removed = difference_record_ids(records_with_alerts, records_to_be_visited)
 
-        # Import data into the REDCap project: Alerts removal
-        to_import_dict = [{'record_id': rec_id, 'child_fu_status': ''} for rec_id in alerts_to_be_removed]
-        response = redcap_project.import_records(to_import_dict, overwrite='overwrite')
-        print("[NON-COMPLIANT] Alerts removal: {}".format(response.get('count')))
+        # Payload of the alerts removal
+        to_remove_dict = [{'record_id': rec_id, 'child_fu_status': ''} for rec_id in alerts_to_be_removed.tolist()]
+        print("[NON-COMPLIANT] Alerts removal: {}".format(len(to_remove_dict)))
     else:
         print("[NON-COMPLIANT] Alerts removal: None")
 
-    # Get list of communities in the health facility catchment area
-    communities = get_list_communities(redcap_project, choice_sep, code_sep)
+    # Payload of the alerts setup. Nothing to build if there are no participants to alert
+    to_setup_dict = []
+    if len(records_to_be_visited) > 0:
+        # Build dataframe with fields to be imported into REDCap (record_id and child_fu_status)
+        to_import_df = build_nc_alerts_df(redcap_project_df, records_to_be_visited, last_return_dates, communities,
+                                          nc_alert_string, today)
+        to_setup_dict = [{'record_id': rec_id, 'child_fu_status': child_fu_status}
+                         for rec_id, child_fu_status in zip(to_import_df.index,
+                                                            to_import_df['child_fu_status'].tolist())]
+    print("[NON-COMPLIANT] Alerts setup: {}".format(len(to_setup_dict)))
 
-    # Build dataframe with fields to be imported into REDCap (record_id and child_fu_status)
-    to_import_df = build_nc_alerts_df(redcap_project_df, records_to_be_visited, communities, nc_alert_string)
-
-    # Import data into the REDCap project: Alerts setup
-    to_import_dict = [{'record_id': rec_id, 'child_fu_status': participant.child_fu_status}
-                      for rec_id, participant in to_import_df.iterrows()]
-    response = redcap_project.import_records(to_import_dict)
-    print("[NON-COMPLIANT] Alerts setup: {}".format(response.get('count')))
+    # Alerts removal and setup, imported together with the rest of alert types of the project
+    return to_remove_dict + to_setup_dict
 
 
 # NEXT VISIT
-def set_nv_alerts(redcap_project, redcap_project_df, nv_alert, nv_alert_string, alert_date_format, days_before,
-                  days_after, blocked_records):
+def set_nv_alerts(redcap_project_df, nv_alert, nv_alert_string, alert_date_format, days_before, days_after, today,
+                  tbv_records, blocked_records, active_alerts):
     """Remove the Next Visit alerts of those participants that have already come to the health facility and setup new
-    alerts for these others that enter in the flag days_before-days_after interval.
+    alerts for these others that enter in the flag days_before-days_after interval. The records are returned to be
+    imported with the rest of alerts.
 
-    :param redcap_project: A REDCap project class to communicate with the REDCap API
-    :type redcap_project: redcap.Project
     :param redcap_project_df: Data frame containing all data exported from the REDCap project
     :type redcap_project_df: pandas.DataFrame
     :param nv_alert: Code of the Next Visit alerts
@@ -444,50 +647,62 @@ def set_nv_alerts(redcap_project, redcap_project_df, nv_alert, nv_alert_string,
     :type days_before: int
     :param days_after: Number of days after today to continue alerting the participant will come
     :type days_before: int
+    :param today: Reference date of the alerts run
+    :type today: numpy.datetime64
+    :param tbv_records: Array of record ids of the participants requiring a household visit after AZi/Pbo
+                        administration
+    :type tbv_records: pandas.Int64Index
     :param blocked_records: Array with the record ids that will be ignored during the alerts setup
     :type blocked_records: pandas.Int64Index
+    :param active_alerts: Activated alerts of the project records classified by alert type
+    :type active_alerts: dict
 
-    :return: None
+    :return: Records to be imported into the REDCap project to remove and setup the Next Visit alerts
+    :rtype: list
     """
 
     # Get the project records ids of the participants who are expected to come tho the HF in the interval days_before
     # and days_after from today
-    records_to_flag = get_record_ids_nv(redcap_project_df, days_before, days_after)
-
-    # Remove those ids that must be ignored
-    if blocked_records is not None:
-        records_to_flag = records_to_flag.difference(blocked_records)
+    records_to_flag, last_return_dates = get_record_ids_nv(redcap_project_df, days_before, days_after, today)
 
-    # Get the project records ids of the participants requiring a household visit after AZi administration. The TO BE
-    # VISITED alert is higher priority than the NEXT VISIT alerts
-    records_to_be_visited = get_record_ids_tbv(redcap_project_df)
+    # Project records ids of the participants requiring a household visit after AZi administration. The TO BE VISITED
+    # alert is higher priority than the NEXT VISIT alerts
+    records_to_be_visited = tbv_records
 
-    # Don't flag with NEXT VISIT those records already marked as TO BE VISITED
-    records_to_flag = records_to_flag.difference(records_to_be_visited)
+    # Don't flag with NEXT VISIT those records already marked as TO BE VISITED and remove those ids that must be
+    # ignored. Both exclusions are fused in a single boolean mask
+    to_flag = ~records_to_flag.isin(records_to_be_visited)
+    if blocked_records is not None:
+        to_flag &= ~records_to_flag.isin(blocked_records)
+    records_to_flag = records_to_flag[to_flag]
 
     # Get the project records ids of the participants with an active alert
-    records_with_alerts = get_active_alerts(redcap_project_df, nv_alert)
+    records_with_alerts = get_active_alerts(active_alerts, nv_alert)
 
     # Check which of the records with alerts are not anymore in the records to flag (i.e. participants with an
     # activated alert that already came to the health facility or they become non-compliant)
+    to_remove_dict = []
     if records_with_alerts is not None:
-        alerts_to_be_removed = records_with_alerts.difference(records_to_flag)
+        alerts_to_be_removed = difference_record_ids(records_with_alerts, records_to_flag)
 
-        # Import data into the REDCap project: Alerts removal
-        to_import_dict = [{'record_id': rec_id, 'child_fu_status': ''} for rec_id in alerts_to_be_removed]
-        response = redcap_project.import_records(to_import_dict, overwrite='overwrite')
-        print("[NEXT VISIT] Alerts removal: {}".format(response.get('count')))
+        # Payload of the alerts removal
+        to_remove_dict = [{'record_id': rec_id, 'child_fu_status': ''} for rec_id in alerts_to_be_removed.tolist()]
+        print("[NEXT VISIT] Alerts removal: {}".format(len(to_remove_dict)))
     else:
         print("[NEXT VISIT] Alerts removal: None")
 
-    # Build dataframe with fields to be imported into REDCap (record_id and child_fu_status)
-    to_import_df = build_nv_alerts_df(redcap_project_df, records_to_flag, nv_alert_string, alert_date_format)
+    # Payload of the alerts setup. Nothing to build if there are no participants to alert
+    to_setup_dict = []
+    if len(records_to_flag) > 0:
+        # Build dataframe with fields to be imported into REDCap (record_id and child_fu_status)
+        to_import_df = build_nv_alerts_df(records_to_flag, last_return_dates, nv_alert_string, alert_date_format)
+        to_setup_dict = [{'record_id': rec_id, 'child_fu_status': child_fu_status}
+                         for rec_id, child_fu_status in zip(to_import_df.index,
+                                                            to_import_df['child_fu_status'].tolist())]
+    print("[NEXT VISIT] Alerts setup: {}".format(len(to_setup_dict)))
 
-    # Import data into the REDCap project: Alerts setup
-    to_import_dict = [{'record_id': rec_id, 'child_fu_status': participant.child_fu_status}
-                      for rec_id, participant in to_import_df.iterrows()]
-    response = redcap_project.import_records(to_import_dict)
-    print("[NEXT VISIT] Alerts setup: {}".format(response.get('count')))
+    # Alerts removal and setup, imported together with the rest of alert types of the project
+    return to_remove_dict + to_setup_dict
 
 
 if __name__ == '__main__':
@@ -498,6 +713,10 @@ if __name__ == '__main__':
     CHOICE_SEP = " | "
     CODE_SEP = ", "
     REDCAP_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+    REDCAP_DAY_FORMAT = "%Y-%m-%d"
+    DATE_COLUMNS = {'int_next_visit': REDCAP_DAY_FORMAT, 'comp_date': REDCAP_DAY_FORMAT, 'int_date': REDCAP_DATE_FORMAT}
+    EXPORT_FIELDS = ['record_id', 'child_fu_status', 'community', 'int_azi', 'hh_child_seen', 'int_date',
+                     'int_next_visit', 'comp_date']  # Only the fields used by the alerts
     ALERT_DATE_FORMAT = "%b %d"
     DAYS_TO_NC = 28  # Defined by PI as 4 weeks
     NC_ALERT = "NC"
@@ -507,24 +726,53 @@ if __name__ == '__main__':
     NV_ALERT = "NEXT VISIT"
     NV_ALERT_STRING = NV_ALERT + ": {return_date}"
     DEFINED_ALERTS = [TBV_ALERT, NC_ALERT, NV_ALERT]
+    IMPORT_CHUNK_SIZE = 500  # Records per REDCap API import request
+
+    # Reference date shared by all the alerts of this run
+    today = numpy.datetime64(datetime.today())
 
     for project_key in PROJECTS:
         project = redcap.Project(URL, PROJECTS[project_key])
 
         # Get all records for each ICARIA REDCap project
         print("[{}] Getting all records from {}...".format(datetime.now(), project_key))
-        df = project.export_records(format='df')
+        df = project.export_records(format='df', fields=EXPORT_FIELDS)
+
+        # Cast the date and integer columns once for all the alerts
+        df = prepare_redcap_data(df, DATE_COLUMNS)
+
+        # Get list of communities in the health facility catchment area
+        catchment_communities = get_list_communities(project, CHOICE_SEP, CODE_SEP)
+
+        # Follow up statuses
+        fu_statuses = get_follow_up_statuses(df)
 
         # Custom status
-        custom_status_ids = get_record_ids_with_custom_status(df, DEFINED_ALERTS)
+        custom_status_ids = get_record_ids_with_custom_status(fu_statuses, DEFINED_ALERTS)
+
+        # Activated alerts
+        active_alert_ids = classify_active_alerts(fu_statuses, DEFINED_ALERTS)
+
+        # Participants requiring a household visit after AZi/Pbo administration. Used by TBV and NEXT VISIT alerts
+        tbv_record_ids = get_record_ids_tbv(df)
 
         # Households to be visited
-        set_tbv_alerts(project, df, TBV_ALERT, TBV_ALERT_STRING, REDCAP_DATE_FORMAT, ALERT_DATE_FORMAT, CHOICE_SEP,
-                       CODE_SEP, custom_status_ids)
+        tbv_records = set_tbv_alerts(df, TBV_ALERT, TBV_ALERT_STRING, ALERT_DATE_FORMAT, catchment_communities,
+                                     tbv_record_ids, custom_status_ids, active_alert_ids)
 
         # Non-compliant visits
-        set_nc_alerts(project, df, NC_ALERT, NC_ALERT_STRING, CHOICE_SEP, CODE_SEP, DAYS_TO_NC, custom_status_ids)
+        nc_records = set_nc_alerts(df, NC_ALERT, NC_ALERT_STRING, catchment_communities, DAYS_TO_NC, today,
+                                   custom_status_ids, active_alert_ids)
 
         # Next visit
-        set_nv_alerts(project, df, NV_ALERT, NV_ALERT_STRING, ALERT_DATE_FORMAT, DAYS_BEFORE_NV, DAYS_AFTER_NV,
-                      custom_status_ids)
+        nv_records = set_nv_alerts(df, NV_ALERT, NV_ALERT_STRING, ALERT_DATE_FORMAT, DAYS_BEFORE_NV, DAYS_AFTER_NV,
+                                   today, tbv_record_ids, custom_status_ids, active_alert_ids)
+
+        # Import all the alerts of the project together. A record may be in the payload of several alert types (e.g.
+        # its alert removed by one type and setup by another one), so only its last status is kept, as if every alert
+        # type was imported in turn. Overwrite is required to save the blank follow up status of the removed alerts
+        to_import_dict = {}
+        for record in itertools.chain(tbv_records, nc_records, nv_records):
+            to_import_dict[record['record_id']] = record
+        imported = import_records_in_chunks(project, list(to_import_dict.values()), IMPORT_CHUNK_SIZE)
+        print("[{}] Records imported: {}".format(project_key, imported))